@@ -0,0 +1,53 @@
+# consolidates a directory of per-slide WSI feature .pt files into a few flat files that
+# train_optuna.py can memory-map, instead of unpickling every slide at startup:
+# - features.npy: the patch features of all slides back to back, (total_patches, D) float16
+# - offsets.npy: slide i owns rows offsets[i]:offsets[i+1] of features.npy
+# - labels.npy: the label of each slide
+# run once per dataset, it writes the files next to the .pt files of both the train and val dirs:
+# $ python data/wsi/prepare.py simclr-ciga512_10
+
+import os
+import sys
+from glob import glob
+from tqdm import tqdm
+import numpy as np
+import torch
+
+dataset = sys.argv[1] if len(sys.argv) > 1 else 'simclr-ciga512_10'
+data_root = '/data/comet-histology-ssl-features'
+
+for data_dir in [os.path.join(data_root, dataset), os.path.join(data_root, dataset + '_val')]:
+    files = sorted(glob(os.path.join(data_dir, '*.pt')))
+    assert len(files) > 0, f"No slides found in {data_dir}"
+
+    # first pass: slide lengths and labels only, so we know how large a memmap to allocate
+    # without holding every slide's features in memory at once
+    lengths = []
+    labels = []
+    for file in tqdm(files, desc=f"sizing {data_dir}"):
+        data = torch.load(file)
+        lengths.append(len(data['features']))
+        labels.append(np.unique(data['labels'])[0])
+        n_dim = data['features'].shape[1]
+    lengths = np.array(lengths, dtype=np.int64)
+    # get_batch samples patches within each slide, an empty slide would silently read its neighbour's rows
+    empty = [os.path.basename(f) for f, l in zip(files, lengths) if l == 0]
+    assert len(empty) == 0, f"slides without any patches in {data_dir}: {empty}"
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    # second pass: stream each slide into the memmap. an .npy memmap rather than a raw .bin,
+    # so the shape and dtype travel with the data
+    filename = os.path.join(data_dir, 'features.npy')
+    arr = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float16, shape=(offsets[-1], n_dim))
+    for i, file in enumerate(tqdm(files, desc=f"writing {filename}")):
+        features = np.asarray(torch.load(file)['features'], dtype=np.float16)
+        # anything beyond float16's range (~65504) would silently turn into inf
+        assert np.isfinite(features).all(), f"{os.path.basename(file)} has features that don't fit in float16"
+        arr[offsets[i]:offsets[i+1]] = features
+    arr.flush()
+    np.save(os.path.join(data_dir, 'offsets.npy'), offsets)
+    np.save(os.path.join(data_dir, 'labels.npy'), np.array(labels).astype(np.int64))
+    print(f"{len(files)} slides, {offsets[-1]:,} patches")
+
+# to read the files later, e.g. with numpy:
+# features = np.load('features.npy', mmap_mode='r')
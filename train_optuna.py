@@ -17,11 +17,15 @@ $ torchrun --nproc_per_node=8 --nnodes=2 --node_rank=1 --master_addr=123.456.123
 """
 
 import os
+import gc
 from glob import glob
 import time
 import math
 import pickle
+import sqlite3
+import subprocess
 from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 
 import optuna #For running param search
 from optuna.trial import TrialState
@@ -30,8 +34,9 @@ remote_server_uri = "http://dnb2.stjude.org:5678"
 
 import numpy as np
 import torch
+import torch._dynamo
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.distributed import init_process_group, destroy_process_group
+from torch.distributed import init_process_group, destroy_process_group, broadcast_object_list
 
 from model import GPTConfig, GPTWSI
 
@@ -84,6 +89,7 @@ compile = True # use PyTorch 2.0 to compile the model to be faster
 n_classes = 17
 search_id = 1
 n_trials = 100
+study_storage = 'journal' # 'journal' or 'sqlite' for new studies. an existing <study_name>.db (and no .log) is always resumed with sqlite
 
 # -----------------------------------------------------------------------------
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
@@ -91,21 +97,95 @@ exec(open('configurator.py').read()) # overrides from command line or config fil
 config = {k: globals()[k] for k in config_keys} # will be useful for logging
 # -----------------------------------------------------------------------------
 
-#Load all .pt files, and concat them into features dict and labels list
+#Memory-map the dataset written by data/wsi/prepare.py: a contiguous (total_patches, D) float16
+# features array, an offsets table mapping slide i to rows offsets[i]:offsets[i+1], and a labels array
 def load_wsi_features(data_dir):
-    files = glob(os.path.join(data_dir, '*.pt'))
-    slides_labels = []
-    features = {}
-    for file in files:
-        data = torch.load(file)
-        slide = os.path.basename(file).split('.')[0]
-        label = np.unique(data['labels'])[0]
-        slides_labels.append((slide, label))
-        features[slide] = data['features']
-    slides_labels = np.array(slides_labels)
-    len_features = {k:len(features[k]) for k in features.keys()}
-    return features, slides_labels, len(slides_labels), len_features
-    
+    features_path = os.path.join(data_dir, 'features.npy')
+    assert os.path.exists(features_path), f"No prepared features in {data_dir}, run data/wsi/prepare.py (or make prepare) first"
+    # copy-on-write mapping: the OS only pages in the rows get_batch touches, and torch gets a
+    # writable array without the file ever being modified
+    all_features = torch.from_numpy(np.load(features_path, mmap_mode='c'))
+    offsets = torch.from_numpy(np.load(os.path.join(data_dir, 'offsets.npy')))
+    labels = torch.from_numpy(np.load(os.path.join(data_dir, 'labels.npy')))
+    assert len(labels) > 0, f"No slides found in {data_dir}, did the dataset load correctly?"
+    lengths = offsets[1:] - offsets[:-1]
+    return all_features, offsets, lengths, labels
+
+#Build the optuna storage for the study, returns it along with the file it lives in
+def make_study_storage(study_name):
+    backend = study_storage
+    # keep existing searches on the backend they were started with, rather than silently
+    # starting a new empty study of the same name in the other file
+    if os.path.exists(f'{study_name}.db') and not os.path.exists(f'{study_name}.log'):
+        if backend != 'sqlite':
+            print(f"found existing study in {study_name}.db, resuming it with sqlite storage")
+        backend = 'sqlite'
+    if backend == 'journal':
+        # append-only log with file locking, avoids sqlite's global writer lock
+        storage_file = f'{study_name}.log'
+        storage = optuna.storages.JournalStorage(optuna.storages.JournalFileStorage(storage_file))
+    else:
+        storage_file = f'{study_name}.db'
+        # WAL mode lets readers proceed while a trial is being written, and persists in the db file
+        conn = sqlite3.connect(storage_file)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.close()
+        storage = optuna.storages.RDBStorage(url=f'sqlite:///{storage_file}',
+                                             engine_kwargs={"connect_args": {"check_same_thread": False}, "pool_pre_ping": True})
+    return storage, storage_file
+
+#Make sure the study's storage file holds every trial, e.g. before committing it. a sqlite db in
+# WAL mode keeps recent commits in <study_name>.db-wal until it is checkpointed, so close the
+# pooled connections and fold the WAL back into the db
+def flush_study_storage(storage, storage_file):
+    if isinstance(storage, optuna.storages.RDBStorage):
+        storage.engine.dispose()
+        conn = sqlite3.connect(storage_file)
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        conn.close()
+
+#Send a picklable object from rank 0 to every rank, a no-op outside of ddp.
+# under the hood this is two broadcasts: the pickled size, then the bytes
+def broadcast_from_master(obj):
+    if ddp:
+        objs = [obj]
+        broadcast_object_list(objs, src=0)
+        obj = objs[0]
+    return obj
+
+#Pick the next free run_<n>_ckpt.pt in out_dir. in-flight saves are waited on first,
+# so that a previous trial's run file is on disk before we glob for it
+def next_out_file():
+    wait_for_saves()
+    runs = [os.path.basename(x) for x in glob(os.path.join(out_dir, '*_ckpt.pt'))]
+    if runs:
+        max_run = max([int(x.split('_')[1]) for x in runs])
+        run_no = max_run + 1
+    else:
+        run_no = 0
+    return os.path.join(out_dir, f'run_{run_no}_ckpt.pt')
+
+#Recursively copy every tensor in a checkpoint to the cpu, leaving everything else as is
+def checkpoint_to_cpu(obj):
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: checkpoint_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(checkpoint_to_cpu(v) for v in obj)
+    return obj
+
+#Checkpoints are written on a single background thread, one at a time in submission order,
+# so neither training nor the next trial waits on pickling and disk IO
+def save_checkpoint_async(checkpoint, out_file):
+    # snapshot to the cpu now, training keeps updating the live tensors in place
+    pending_saves.append(save_executor.submit(torch.save, checkpoint_to_cpu(checkpoint), out_file))
+
+#Block until all submitted checkpoint saves are on disk, re-raising any error from them
+def wait_for_saves():
+    while pending_saves:
+        pending_saves.pop(0).result()
+
 def suggest_params(trial):
     block_size = trial.suggest_categorical('block_size', [64, 128, 256, 512])
     n_layer = trial.suggest_int('n_layer', 4, 10)
@@ -131,23 +211,13 @@ def suggest_params(trial):
 
 def objective(trial):
 
-    trial = optuna.integration.TorchDistributedTrial(trial)
-
-    train_data = load_wsi_features(data_dir)
-    val_data = load_wsi_features(val_data_dir)
-
-    if master_process:
-        runs = [os.path.basename(x) for x in glob(os.path.join(out_dir, '*_ckpt.pt'))]
-        if runs:
-            max_run = max([int(x.split('_')[1]) for x in runs])
-            run_no = max_run + 1
-        else:
-            run_no = 0
-        out_file = os.path.join(out_dir, f'run_{run_no}_ckpt.pt')
+    out_file = None # picked at this trial's first checkpoint save, see next_out_file
 
     # if master_process:
     #     mlflow.pytorch.autolog(log_every_n_step = 150, log_models = False)
-    params = suggest_params(trial)
+    # only rank 0 talks to optuna, the sampled params then reach the other ranks in a single
+    # broadcast rather than one per suggest_* call as with TorchDistributedTrial
+    params = broadcast_from_master(suggest_params(trial) if master_process else None)
     block_size = params['block_size']
     n_layer = params['n_layer']
     dropout = params['dropout']
@@ -173,19 +243,23 @@ def objective(trial):
         # helps estimate an arbitrarily accurate loss over either split using many batches
         @torch.no_grad()
         def estimate_loss():
-            out = {}
+            stats = {}
             model.eval()
             for split in ['train', 'val']:
-                n_correct = 0
-                losses = torch.zeros(eval_iters)
+                # accumulate in place on the device, nothing here waits on the GPU
+                correct_tally = torch.zeros((), dtype=torch.int64, device=device)
+                losses = torch.zeros(eval_iters, device=device)
                 for k in range(eval_iters):
                     X, Y = get_batch(split)
+                    wait_for_batch()
                     with ctx:
                         logits, loss = model(X, Y)
-                    losses[k] = loss.item()
-                    n_correct += torch.sum(torch.argmax(logits, dim = 1) == Y)
-                out[split + '_acc'] = n_correct / (batch_size * eval_iters)
-                out[split] = losses.mean()
+                    losses[k] = loss.detach()
+                    correct_tally += (logits.argmax(dim=-1) == Y).sum()
+                stats[split + '_acc'] = correct_tally.float() / (batch_size * eval_iters)
+                stats[split] = losses.mean()
+            # a single device->host sync for the stats of both splits
+            out = dict(zip(stats.keys(), torch.stack(list(stats.values())).tolist()))
             model.train()
             return out
 
@@ -203,31 +277,54 @@ def objective(trial):
             coeff = 0.5 * (1.0 + math.cos(math.pi * decay_ratio)) # coeff ranges 0..1
             return min_lr + coeff * (learning_rate - min_lr)
 
+        # preallocated staging buffers for get_batch, filled in place every iteration.
+        # they are pinned on cuda so the H2D copy can be async, which also means we
+        # have to wait for the previous copy out of them to finish before refilling
+        pin = device_type == 'cuda'
+        X_buf = torch.empty((batch_size, block_size, train_data[0].shape[1]), dtype=train_data[0].dtype, pin_memory=pin)
+        Y_buf = torch.empty((batch_size,), dtype=torch.int64, pin_memory=pin)
+        copy_done = torch.cuda.Event() if pin else None
+
         #This will randomly choose a set of slides (batch_size)
         # and return a random selection of (block_size) patches for each element
         # x = (batch_size x block_size x feature_dim)
         # y = (batch_size x 1)
         def get_batch(split):
             data = train_data if split == 'train' else val_data
-            features, slides_labels, n_slides, len_features = data
-            
-            assert n_slides > 0, f"No slides found in {split}, did the dataset load correctly?"
-
-            #Randomly choose set of slides
-            n_slides = len(slides_labels)
-            batch_indices = np.random.choice(n_slides, size = batch_size, replace = True)
-            slides = [s[0] for s in slides_labels[batch_indices]]
-            labels = [s[1] for s in slides_labels[batch_indices]]
-            sample_indices = [np.random.choice(len_features[s], size = block_size, replace = True) for s in slides]
-            x = torch.stack([torch.from_numpy(features[s][sample_indices[idx],:]) for idx, s in enumerate(slides)])
-            y = torch.from_numpy(np.array(labels, dtype = np.int64))
+            features, offsets, lengths, labels = data
+
+            #Randomly choose set of slides, then (with replacement) block_size patches from each.
+            # uses torch's generator (seeded per rank at startup), and floor(u * length) with u in [0, 1)
+            # gives every slide its own upper bound in a single vectorized draw
+            batch_idx = torch.randint(len(labels), (batch_size,))
+            sample_idx = (torch.rand(batch_size, block_size, dtype=torch.float64) * lengths[batch_idx][:, None]).long()
+            # absolute row of every sampled patch in the contiguous features tensor, gathered in one go
+            flat_idx = (offsets[batch_idx][:, None] + sample_idx).view(-1)
+            if copy_done is not None:
+                copy_done.synchronize()
+            torch.index_select(features, 0, flat_idx, out = X_buf.view(-1, X_buf.size(-1)))
+            torch.index_select(labels, 0, batch_idx, out = Y_buf)
 
             if device_type == 'cuda':
-                # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-                x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
+                # buffers are already pinned, so this is just two async DMAs. they are issued on a
+                # dedicated stream to overlap with the backward pass queued on the compute stream
+                with torch.cuda.stream(copy_stream):
+                    x, y = X_buf.to(device, non_blocking=True), Y_buf.to(device, non_blocking=True)
+                    copy_done.record()
+                    x = x.float()
+                # x, y are allocated on the copy stream but consumed on the compute stream
+                x.record_stream(torch.cuda.current_stream())
+                y.record_stream(torch.cuda.current_stream())
             else:
-                x, y = x.to(device), y.to(device)
+                # copy out of the staging buffers, the next get_batch call overwrites them
+                x, y = X_buf.float(), Y_buf.clone()
             return x, y
+
+        # make the compute stream wait for the batch copies issued by get_batch. this only orders
+        # work on the GPU, the host doesn't block
+        def wait_for_batch():
+            if copy_stream is not None:
+                torch.cuda.current_stream().wait_stream(copy_stream)
             
         # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
         iter_num = 0
@@ -291,16 +388,20 @@ def objective(trial):
         optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
         if init_from == 'resume':
             optimizer.load_state_dict(checkpoint['optimizer'])
+            del checkpoint, state_dict # everything we need has been copied out, free it
 
         # compile the model
         if compile:
             print("compiling the model... (takes a ~minute)")
-            unoptimized_model = model
-            model = torch.compile(model) # requires PyTorch 2.0
+            # shapes are static within a trial (get_batch always fills the same preallocated buffers),
+            # so specialize on them and let reduce-overhead capture the step into CUDA graphs
+            model = torch.compile(model, mode="reduce-overhead", fullgraph=False, dynamic=False) # requires PyTorch 2.0
 
         # wrap model into DDP container
+        # grads are views into the allreduce buckets (no grad<->bucket copies), the graph is the
+        # same every step, and larger buckets mean fewer allreduce launches during backward
         if ddp:
-            model = DDP(model, device_ids=[ddp_local_rank])
+            model = DDP(model, device_ids=[ddp_local_rank], gradient_as_bucket_view=True, static_graph=True, bucket_cap_mb=50)
 
         # training loop
         X, Y = get_batch('train') # fetch the very first batch
@@ -308,61 +409,91 @@ def objective(trial):
         local_iter_num = 0 # number of iterations in the lifetime of this process
         raw_model = model.module if ddp else model # unwrap DDP container if needed
         running_mfu = -1.0
+        lr = learning_rate if not decay_lr else min_lr # only used as-is once the schedule has finished
+        last_lr = None # lr currently set in the optimizer param groups
+        pruned = False
+        # on log steps the loss is copied to a pinned host buffer asynchronously and only printed
+        # at the next log step, by which time it has long arrived, so logging never stalls the GPU
+        lossf_buf = torch.zeros((), pin_memory=(device_type == 'cuda'))
+        loss_copied = torch.cuda.Event() if device_type == 'cuda' else None
+        pending_log = None # (iter_num, dt, running_mfu) of the log line waiting on lossf_buf
+
+        def print_pending_log():
+            if loss_copied is not None:
+                loss_copied.synchronize()
+            it, it_dt, it_mfu = pending_log
+            print(f"iter {it}: loss {lossf_buf.item():.4f}, time {it_dt*1000:.2f}ms, mfu {it_mfu*100:.2f}%")
+
         while True:
 
-            # determine and set the learning rate for this iteration
-            lr = get_lr(iter_num) if decay_lr else learning_rate
-            for param_group in optimizer.param_groups:
-                param_group['lr'] = lr
-
-            # evaluate the loss on train/val sets and write checkpoints
-            if iter_num % eval_interval == 0 and master_process:
-                losses = estimate_loss()
-                print(f"step {iter_num}: train loss {losses['train']:.4f}, train acc {losses['train_acc']:.4f}, val loss {losses['val']:.4f}, val acc {losses['val_acc']:.4f}")
-                if wandb_log:
-                    wandb.log({
-                        "iter": iter_num,
-                        "train/loss": losses['train'],
-                        "val/loss": losses['val'],
-                        "lr": lr,
-                        "mfu": running_mfu*100, # convert to percentage
-                    })
-                #For search, don't save checkpoint
-                if losses['val_acc'] > best_val_acc or always_save_checkpoint:
-                    best_val_acc = losses['val_acc']
-                    if iter_num > 0:
-                        checkpoint = {
-                            'model': raw_model.state_dict(),
-                            'optimizer': optimizer.state_dict(),
-                            'model_args': model_args,
-                            'iter_num': iter_num,
-                            'best_val_acc': best_val_acc,
-                            'config': config,
-                        }
-                        print(f"saving checkpoint to {out_dir}")
-                        torch.save(checkpoint, out_file)
+            # determine and set the learning rate for this iteration. past lr_decay_iters it is
+            # constant, so stop recomputing it, and only touch the param groups when it changes
+            lr = get_lr(iter_num) if decay_lr and iter_num <= lr_decay_iters else lr
+            if lr != last_lr:
+                for param_group in optimizer.param_groups:
+                    param_group['lr'] = lr
+                last_lr = lr
+
+            # evaluate the loss on train/val sets, write checkpoints and let the pruner stop bad trials early
+            if iter_num % eval_interval == 0:
+                prune = False
+                if master_process:
+                    losses = estimate_loss()
+                    print(f"step {iter_num}: train loss {losses['train']:.4f}, train acc {losses['train_acc']:.4f}, val loss {losses['val']:.4f}, val acc {losses['val_acc']:.4f}")
+                    if wandb_log:
+                        wandb.log({
+                            "iter": iter_num,
+                            "train/loss": losses['train'],
+                            "val/loss": losses['val'],
+                            "lr": lr,
+                            "mfu": running_mfu*100, # convert to percentage
+                        })
+                    #For search, don't save checkpoint
+                    if losses['val_acc'] > best_val_acc or always_save_checkpoint:
+                        best_val_acc = losses['val_acc']
+                        if iter_num > 0:
+                            checkpoint = {
+                                'model': raw_model.state_dict(),
+                                'optimizer': optimizer.state_dict(),
+                                'model_args': model_args,
+                                'iter_num': iter_num,
+                                'best_val_acc': best_val_acc,
+                                'config': config,
+                            }
+                            if out_file is None:
+                                out_file = next_out_file()
+                            print(f"saving checkpoint to {out_file}")
+                            save_checkpoint_async(checkpoint, out_file)
+                            del checkpoint # references the live params and optimizer state, don't keep it around
+                    # report the intermediate score, the pruner may then cut this trial short
+                    trial.report(losses['val_acc'], iter_num)
+                    prune = trial.should_prune()
+                # all ranks have to stop at the same step, or the others hang in the next allreduce
+                if broadcast_from_master(prune):
+                    pruned = True
+                    break
             if iter_num == 0 and eval_only:
                 break
 
             # forward backward update, with optional gradient accumulation to simulate larger batch size
             # and using the GradScaler if data type is float16
             for micro_step in range(gradient_accumulation_steps):
-                if ddp:
-                    # in DDP training we only need to sync gradients at the last micro step.
-                    # the official way to do this is with model.no_sync() context manager, but
-                    # I really dislike that this bloats the code and forces us to repeat code
-                    # looking at the source of that context manager, it just toggles this variable
-                    model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-                with ctx:
-                    logits, loss = model(X, Y)
-                # immediately async prefetch next batch while model is doing the forward pass on the GPU
-                X, Y = get_batch('train')
-                # backward pass, with gradient scaling if training in fp16
-                scaler.scale(loss).backward()
+                # in DDP training we only need to sync gradients at the last micro step, so the
+                # first K-1 backward passes run under no_sync() and skip the AllReduce entirely
+                ctx_sync = model.no_sync() if (ddp and micro_step < gradient_accumulation_steps - 1) else nullcontext()
+                with ctx_sync:
+                    wait_for_batch()
+                    with ctx:
+                        logits, loss = model(X, Y)
+                    # immediately async prefetch next batch while model is doing the forward pass on the GPU
+                    X, Y = get_batch('train')
+                    # backward pass, with gradient scaling if training in fp16
+                    scaler.scale(loss).backward()
             # clip the gradient
             if grad_clip != 0.0:
                 scaler.unscale_(optimizer)
-                torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+                # foreach computes the norms of all grads in a handful of fused kernels (cuda only)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip, foreach=(device_type == 'cuda'))
             # step the optimizer and scaler if training in fp16
             scaler.step(optimizer)
             scaler.update()
@@ -374,11 +505,15 @@ def objective(trial):
             dt = t1 - t0
             t0 = t1
             if iter_num % log_interval == 0 and master_process:
-                lossf = loss.item() # loss as float. note: this is a CPU-GPU sync point
                 if local_iter_num >= 5: # let the training loop settle a bit
                     mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
                     running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-                print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+                if pending_log is not None:
+                    print_pending_log()
+                lossf_buf.copy_(loss.detach(), non_blocking=True)
+                if loss_copied is not None:
+                    loss_copied.record()
+                pending_log = (iter_num, dt, running_mfu)
             iter_num += 1
             local_iter_num += 1
 
@@ -386,6 +521,9 @@ def objective(trial):
             if iter_num > max_iters:
                 break
 
+        if pending_log is not None:
+            print_pending_log()
+
         run_name = run.info.run_name
         run_id = run.info.run_id
         artifact_path = run.info.artifact_uri
@@ -400,6 +538,26 @@ def objective(trial):
         #     mlflow.pytorch.log_model(model, "model")
         #     model_path = os.path.join(artifact_path, 'model')
 
+    if pruned:
+        raise optuna.TrialPruned()
+    return best_val_acc
+
+#Run one trial, then release its model, optimizer state and batches before the next trial
+# allocates its own, so the caching allocator doesn't fragment across trials. this has to
+# happen once objective has returned (or raised), when all of its locals are really gone
+def run_trial(trial):
+    pruned = False
+    try:
+        best_val_acc = objective(trial)
+    except optuna.TrialPruned:
+        pruned = True # re-raised below, after the cleanup, so objective's frame isn't kept alive by the traceback
+    # every trial compiles a brand new module, which dynamo would otherwise add as yet another cache
+    # entry next to the stale ones; once those hit cache_size_limit it silently falls back to eager
+    torch._dynamo.reset()
+    gc.collect()
+    torch.cuda.empty_cache()
+    if pruned:
+        raise optuna.TrialPruned()
     return best_val_acc
 
 if __name__ == "__main__":
@@ -431,6 +589,8 @@ if __name__ == "__main__":
 
     if master_process:
         os.makedirs(out_dir, exist_ok=True)
+    save_executor = ThreadPoolExecutor(max_workers=1)
+    pending_saves = []
 
     torch.manual_seed(1337 + seed_offset)
     torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
@@ -439,24 +599,33 @@ if __name__ == "__main__":
     # note: float16 data type will automatically use a GradScaler
     ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
     ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+    copy_stream = torch.cuda.Stream() if device_type == 'cuda' else None # H2D batch copies, see get_batch
+
+    # the dataset is the same for every trial, so map it once for the whole search
+    train_data = load_wsi_features(data_dir)
+    val_data = load_wsi_features(val_data_dir)
 
     study_name = f'{dataset}_{search_id}'
-    storage_name = "sqlite:///{}.db".format(study_name)
 
     study = None
     if master_process:
+        storage, storage_file = make_study_storage(study_name)
         study = optuna.create_study(direction="maximize", 
                                     study_name = study_name, 
-                                    storage = storage_name,
-                                    load_if_exists = True)
-        study.optimize(objective, n_trials=n_trials)
+                                    storage = storage,
+                                    load_if_exists = True,
+                                    pruner = optuna.pruners.HyperbandPruner(min_resource = eval_interval, max_resource = max_iters))
+        study.optimize(run_trial, n_trials=n_trials)
     else:
         for _ in range(n_trials):
             try:
-                objective(None)
+                run_trial(None)
             except optuna.TrialPruned:
                 pass
 
+    wait_for_saves()
+    save_executor.shutdown()
+
     if master_process:
         assert study is not None
         pruned_trials = study.get_trials(deepcopy=False, states=[TrialState.PRUNED])
@@ -476,10 +645,14 @@ if __name__ == "__main__":
         for key, value in trial.params.items():
             print("    {}: {}".format(key, value))
 
-        cmd = f"git add {study_name}.db; git commit -m 'Update repo'; git push origin"
-        print("Sync db with git repo:")
-        print(cmd)
-        os.system(cmd)
+        # opt-in, and fire-and-forget in its own session so the push neither blocks the ddp teardown
+        # below nor gets killed along with this process
+        if os.environ.get('SYNC_STUDY_DB'):
+            flush_study_storage(storage, storage_file)
+            cmd = f"git add {storage_file}; git commit -m 'Update repo'; git push origin"
+            print("Sync db with git repo (in the background):")
+            print(cmd)
+            subprocess.Popen(cmd, shell=True, start_new_session=True)
 
     if ddp:
         destroy_process_group()